@@ -0,0 +1,12 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+# --- 行情資料 (SoA) ---
+# load_data 只快取下游實際用到的欄位與其技術指標，不再保存整張 OHLCV DataFrame
+# 類別放在獨立模組：Streamlit 腳本內定義的類別無法被 st.cache_data 正確 pickle
+@dataclass(frozen=True, slots=True)
+class Bars:
+    close: np.ndarray   # 收盤價，float64 連續陣列，已向前填補
+    dates: np.ndarray   # 交易日，datetime64[D]（交易所當地日期）
+    indicators: dict    # 指標欄位名稱 -> 與 close 等長的 ndarray
@@ -0,0 +1,88 @@
+import numpy as np
+from numba import njit
+
+# --- 技術指標 JIT 核心 ---
+# 直接在 Close 的 ndarray 上運算，回傳純 ndarray，避開 pandas_ta 的包裝開銷
+# 前 n-1 筆資料不足一個視窗，一律填 NaN（與 pandas rolling 行為一致）
+
+
+# 不開 fastmath：NaN 語意需保持正確（fastmath 允許 LLVM 假設輸入沒有 NaN）
+@njit(cache=True)
+def fused_indicators(x, n=20, k=2.0):
+    # 單次走訪同時產生布林上下軌與滑動標準差，回傳 (upper, lower, std)
+    # 上下軌採母體標準差 (ddof=0)，與 pandas_ta.bbands 相同；std 為樣本標準差 (ddof=1)，與 pandas .std() 相同
+    upper = np.full(x.size, np.nan)
+    lower = np.full(x.size, np.nan)
+    std = np.full(x.size, np.nan)
+    mean = 0.0   # 視窗平均
+    m2 = 0.0     # 視窗平方差和 (Welford)
+    for i in range(x.size):
+        v = x[i]
+        if i < n:
+            delta = v - mean
+            mean += delta / (i + 1)
+            m2 += delta * (v - mean)
+        else:
+            old = x[i - n]
+            new_mean = mean + (v - old) / n
+            m2 += (v - old) * (v - new_mean + old - mean)
+            mean = new_mean
+        if i >= n - 1:
+            ss = max(m2, 0.0)
+            sd = np.sqrt(ss / n)
+            std[i] = np.sqrt(ss / (n - 1))
+            upper[i] = mean + k * sd
+            lower[i] = mean - k * sd
+    return upper, lower, std
+
+
+@njit(cache=True)
+def ffill(a):
+    # 向前填補缺值：NaN 沿用前一筆有效值，開頭的 NaN 保留
+    out = np.empty_like(a)
+    last = np.nan
+    for i in range(a.size):
+        v = a[i]
+        if not np.isnan(v):
+            last = v
+        out[i] = last
+    return out
+
+
+# --- 趨勢預測 JIT 核心 ---
+@njit(cache=True, fastmath=True)
+def cubic_forecast(coef, future_t, y):
+    # 三次擬合係數 c = coef @ y 與 Horner 求值合併在同一個函式內，不產生中間陣列
+    # coef 為 4 x n 的最小平方封閉解，future_t 為縮放後的未來座標
+    c0 = 0.0
+    c1 = 0.0
+    c2 = 0.0
+    c3 = 0.0
+    for i in range(y.size):
+        v = y[i]
+        c0 += coef[0, i] * v
+        c1 += coef[1, i] * v
+        c2 += coef[2, i] * v
+        c3 += coef[3, i] * v
+    out = np.empty(future_t.size)
+    for j in range(future_t.size):
+        t = future_t[j]
+        out[j] = ((c0 * t + c1) * t + c2) * t + c3
+    return out
+
+
+# 模組載入時先用極短陣列觸發編譯，避免第一次 Streamlit rerun 才付 JIT 成本
+_warm = np.zeros(2)
+ffill(_warm)
+# pandas 3 (copy-on-write) 的 Series.to_numpy(copy=False) 回傳唯讀陣列，唯讀型別也要先編譯
+_warm_ro = np.zeros(2)
+_warm_ro.setflags(write=False)
+ffill(_warm_ro)
+fused_indicators(_warm, 2, 2.0)
+# 與 stock_app._cubic_design 回傳的型別一致：C 連續、唯讀
+_coef = np.zeros((4, 2))
+_coef.setflags(write=False)
+_warm_t = np.zeros(2)
+_warm_t.setflags(write=False)
+cubic_forecast(_coef, _warm_t, _warm)
+del _warm, _warm_ro, _coef, _warm_t
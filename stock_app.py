@@ -1,52 +1,164 @@
 import streamlit as st
-import yfinance as yf
 import pandas as pd
-import pandas_ta as ta
-import matplotlib.pyplot as plt
 import numpy as np
-from datetime import datetime, timedelta
+import os
+import re
+import tempfile
+import time
+from datetime import datetime
+from functools import lru_cache
+from math import fabs
+from pathlib import Path
+
+from bars import Bars
+from indicators import cubic_forecast, ffill, fused_indicators
 
 # --- 1. 自動校正快取設定 ---
 # 將 ttl 設為 3600 秒 (1小時)，或配合台股收盤時間
 # 這樣每天你開啟時，它都會自動抓取最新收盤後的數據進行校正
-@st.cache_data(ttl=3600)
-def load_data(sid):
+CACHE_TTL = 3600
+CACHE_DIR = Path(".cache")
+
+# 代碼會直接拼進檔名，只接受合法的股票代碼字元，避免 "../" 之類的路徑跳出 CACHE_DIR
+_TICKER_RE = re.compile(r"^[A-Z0-9.^=\-]{1,20}$")
+
+def _cache_path(sid):
+    # 不合法的代碼回傳 None，呼叫端一律視為無效代碼
+    if not _TICKER_RE.match(sid):
+        return None
+    path = CACHE_DIR / f"{sid}.parquet"
+    if path.resolve().parent != CACHE_DIR.resolve():
+        return None
+    return path
+
+def _download(sid, **kwargs):
+    # 只有需要連網時才匯入 yfinance（連帶載入 curl_cffi 等）
+    import yfinance as yf
+    # 不需要股利/分割欄位 (actions=False)
+    df = yf.Ticker(sid).history(interval="1d", actions=False, **kwargs)
+    if df.empty: return None
+    df.columns = [c.capitalize() for c in df.columns]
+    if isinstance(df.columns, pd.MultiIndex):
+        df.columns = df.columns.get_level_values(0)
+    # 下游只用到收盤價，其餘欄位不寫進磁碟快取
+    return df[['Close']]
+
+def _fetch_history(sid):
+    # 磁碟上的 parquet 快取：Streamlit 重啟後不必再走一次 HTTPS + JSON 解析
+    # 檔案超過 CACHE_TTL 就視為過期，維持收盤後自動更新的行為
+    path = _cache_path(sid)
+    if path is None:
+        return None
+    cached = None
     try:
-        ticker = yf.Ticker(sid)
-        # 抓取包含最新收盤價的兩年資料
-        df = ticker.history(period="2y", interval="1d")
-        if df.empty: return None
-        df.columns = [c.capitalize() for c in df.columns]
-        if isinstance(df.columns, pd.MultiIndex):
-            df.columns = df.columns.get_level_values(0)
+        if path.exists():
+            cached = pd.read_parquet(path)
+            if time.time() - path.stat().st_mtime < CACHE_TTL:
+                return cached
+    except Exception:
+        cached = None
+    try:
+        df = None
+        if cached is not None and len(cached) >= 2:
+            # 增量更新：從倒數第二根K棒起補抓，最後一根可能是盤中價格，一併覆蓋
+            # 倒數第二根已收盤，若價格對不上代表除權息後歷史被還原調整，改為整段重抓
+            anchor = cached.index[-2]
+            new = _download(sid, start=anchor.strftime("%Y-%m-%d"))
+            if (new is not None and new.index[0] == anchor
+                    and np.isclose(new['Close'].iloc[0], cached['Close'].iloc[-2])):
+                df = pd.concat([cached.iloc[:-2], new])
+                df = df[~df.index.duplicated(keep="last")]
+                df = df[df.index > df.index[-1] - pd.DateOffset(years=2)]
+        if df is None:
+            # 抓取包含最新收盤價的兩年資料
+            df = _download(sid, period="2y")
+            if df is None: return cached
+        # 先寫到同目錄的暫存檔再原子替換，其他 session 同時讀取時不會讀到寫一半的檔案
+        tmp = None
+        try:
+            CACHE_DIR.mkdir(exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+            os.close(fd)
+            df.to_parquet(tmp)
+            os.replace(tmp, path)
+        except Exception:
+            # 寫不進磁碟快取不影響本次結果
+            if tmp is not None:
+                Path(tmp).unlink(missing_ok=True)
         return df
     except:
+        # 連線失敗或被限流時，沿用磁碟上過期但可用的歷史；檔案未更新，下一個 TTL 週期會再重試
+        return cached
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False, max_entries=64)
+def load_data(sid):
+    df = _fetch_history(sid)
+    if df is None:
         return None
+    # 收盤價缺值只在載入時填補一次；日期去掉時區，保留交易所當地日期
+    close = ffill(np.ascontiguousarray(df['Close'].to_numpy(dtype=np.float64, copy=False)))
+    dates = df.index.tz_localize(None).values.astype("datetime64[D]")
+    # 向前填補後只剩開頭可能是 NaN，直接截掉，否則滑動視窗與擬合會整段變成 NaN
+    valid = np.flatnonzero(~np.isnan(close))
+    if valid.size == 0:
+        return None
+    close, dates = close[valid[0]:], dates[valid[0]:]
+    # 指標和下載結果一起快取，分頁 rerun 時不必再查一次指標快取
+    return Bars(close, dates, compute_indicators(close))
 
-# --- 2. 自動優化模型函數 ---
-def run_auto_calibration_model(df, periods=7):
-    # 此函式即為「校正引擎」
-    # 每次執行都會根據 df 內的最新日期，重新計算權重
-    y = df['Close'].fillna(method='ffill').values
-    x = np.arange(len(y))
+# --- 2. 技術指標 ---
+# 指標參數與欄位名稱（沿用 pandas_ta 的命名，如 BBU_20_2.0、STDEV_20）
+BB_LENGTH, BB_STD = 20, 2.0
+STDEV = f"STDEV_{BB_LENGTH}"
+BBU, BBL = (f"{p}_{BB_LENGTH}_{BB_STD}" for p in ("BBU", "BBL"))
+
+# 由 load_data 在下載後呼叫一次，結果隨 Bars 一起快取
+def compute_indicators(close):
+    # 布林通道與滑動標準差在同一個 JIT 迴圈內一次算完，只保留分頁實際用到的欄位
+    upper, lower, std = fused_indicators(close, BB_LENGTH, BB_STD)
+    return {BBU: upper, BBL: lower, STDEV: std}
+
+# --- 3. 自動優化模型函數 ---
+# 三次加權擬合的係數是 y 的線性函數：c = coef @ y，其中 coef 與未來座標只和 (n, periods) 有關，依此快取
+# x 先線性縮放到 [-1, 1]，避免 x**6 量級的項讓 4x4 系統病態
+# 資料不足 4 筆時（新上市股票）降為 n-1 次擬合，高次項係數補 0，否則 4x4 矩陣奇異
+@lru_cache(maxsize=8)
+def _cubic_design(n, periods):
+    scale = 2.0 / max(n - 1, 1)
+    t = np.arange(n, dtype=np.float64) * scale - 1.0
+    future_t = np.arange(n, n + periods, dtype=np.float64) * scale - 1.0
     
     # 強化學習權重：將最後一天的權重設為最高，達成收盤後的即時修正
-    weights = np.linspace(0.1, 1.0, len(y))
+    weights = np.linspace(0.1, 1.0, n)
     
-    # 進行多項式擬合
-    z = np.polyfit(x, y, 3, w=weights) 
-    p = np.poly1d(z)
+    deg = min(3, n - 1)
+    wv = np.vander(t, deg + 1) * weights[:, None]
+    gram = wv.T @ wv                     # 正規方程式左側 (最多 4x4)
+    proj = (wv * weights[:, None]).T     # 右側 = proj @ y
+    coef = np.zeros((4, n))              # 4 x n，正規方程式的封閉解
+    coef[3 - deg:] = np.linalg.solve(gram, proj)
+    for arr in (coef, future_t):
+        arr.setflags(write=False)
+    return coef, future_t
+
+@st.cache_data(ttl=CACHE_TTL)
+def run_auto_calibration_model(sid, last_ts, last_close, _close, periods=7):
+    # 此函式即為「校正引擎」
+    # 每次執行都會根據最新一根K棒的資料，重新計算權重
+    # 結果只取決於 (代碼, 最後日期, 最新收盤價, 預測天數)，相同輸入直接回傳快取
     
-    future_x = np.arange(len(y), len(y) + periods)
-    forecast = p(future_x)
-    return forecast
+    # 進行多項式擬合：與 np.polyfit(x, y, 3, w=weights) 相同的加權最小平方，
+    # 4x4 系統已在 _cubic_design 解好，剩下的內積與 Horner 求值交給 JIT 核心
+    coef, future_t = _cubic_design(len(_close), periods)
+    return cubic_forecast(coef, future_t, _close)
 
 # --- 頁面配置 ---
 st.set_page_config(page_title="台股 AI 自動校正系統", layout="wide")
 
 # --- 側邊欄 ---
 st.sidebar.header("📊 系統監控中心")
-stock_id = st.sidebar.text_input("輸入代碼 (例: 2330.TW)", value="2330.TW").upper()
+# 先正規化代碼再當快取鍵，" 2330.tw " 與 "2330.TW" 共用同一筆快取
+stock_id = st.sidebar.text_input("輸入代碼 (例: 2330.TW)", value="2330.TW").strip().upper()
 
 # 顯示最後校正狀態
 now = datetime.now()
@@ -57,62 +169,83 @@ else:
     st.sidebar.info("⏳ 盤中時段：目前使用昨日收盤數據為基準。")
 
 # --- 主程式 ---
-df = load_data(stock_id)
+# load_data 關閉了自身的 spinner，這裡統一顯示載入提示
+with st.spinner("⏳ 正在載入行情資料..."):
+    bars = load_data(stock_id)
 
-if df is None:
+if bars is None:
     st.error("❌ 無法獲取數據，請確認代號正確。")
 else:
+    # 各分頁與模型一律直接使用快取中的 float64 收盤價陣列
+    close = bars.close
+    # 只有一根K棒（剛上市）時沒有前一日可比，視為持平
+    last_close = float(close[-1])
+    prev_close = float(close[-2]) if close.size > 1 else last_close
+    last_ts = bars.dates[-1]
+    ind = bars.indicators
+
     tab1, tab2, tab3 = st.tabs(["🔴 每日檢驗報告", "🔮 AI 趨勢校正圖", "⚙️ 模型學習日誌"])
 
     # --- TAB 1: 即時檢驗 ---
     with tab1:
         st.subheader(f"{stock_id} 盤後自動檢驗")
-        bb = ta.bbands(df['Close'], length=20, std=2)
-        if bb is not None:
-            df = pd.concat([df, bb], axis=1)
-            upper_col = [c for c in bb.columns if c.startswith('BBU')][0]
-            lower_col = [c for c in bb.columns if c.startswith('BBL')][0]
-            
-            last_price = df['Close'].iloc[-1]
-            st.metric("最新收盤價 (已校正)", f"{last_price:.2f}", 
-                      f"{last_price - df['Close'].iloc[-2]:.2f}")
-            
-            st.line_chart(df[['Close', upper_col, lower_col]].tail(60))
+        st.metric("最新收盤價 (已校正)", f"{last_close:.2f}", 
+                  f"{last_close - prev_close:.2f}")
+        
+        st.line_chart(pd.DataFrame(
+            {"Close": close[-60:], BBU: ind[BBU][-60:], BBL: ind[BBL][-60:]},
+            index=bars.dates[-60:],
+        ))
 
     # --- TAB 2: 自動校正預測 ---
     with tab2:
         st.subheader("🔮 AI 自動校正趨勢")
         # 每次點擊按鈕，都會觸發 run_auto_calibration_model 使用最新數據
+        # 結果存進 session_state：切換代碼以外的互動造成 rerun 時，圖表不會消失
+        forecast_key = (stock_id, str(last_ts), last_close)
         if st.button("執行最新校正預測"):
-            forecast = run_auto_calibration_model(df)
-            std_dev = df['Close'].tail(20).std()
-            
-            fig, ax = plt.subplots(figsize=(10, 5))
-            recent_data = df['Close'].tail(40).values
-            ax.plot(recent_data, label="實際走勢 (已納入最新收盤)", color="#1f77b4", linewidth=2)
-            
-            x_future = np.arange(len(recent_data), len(recent_data) + 7)
-            ax.plot(x_future, forecast, color="red", linestyle="--", label="校正後預測線")
-            ax.fill_between(x_future, forecast - std_dev, forecast + std_dev, color='red', alpha=0.1)
+            st.session_state["forecast"] = run_auto_calibration_model(stock_id, last_ts, last_close, close)
+            st.session_state["forecast_key"] = forecast_key
+        if st.session_state.get("forecast_key") == forecast_key:
+            forecast = st.session_state["forecast"]
+            # 近 20 日標準差直接取自指標核心的滑動標準差，不再另外切片計算
+            std_dev = ind[STDEV][-1]
+            if np.isnan(std_dev) and close.size > 1:
+                # 不足一個視窗（新上市股票）時，改用現有資料計算樣本標準差
+                std_dev = np.std(close[-BB_LENGTH:], ddof=1)
             
-            ax.legend()
-            st.pyplot(fig)
+            # 交給瀏覽器端繪圖：實際值與預測值各自以 NaN 補齊到同一長度
+            recent_data = close[-40:]
+            gap = np.full(len(recent_data), np.nan)
+            tail = np.full(len(forecast), np.nan)
+            chart_df = pd.DataFrame({
+                "實際走勢 (已納入最新收盤)": np.concatenate([recent_data, tail]),
+                "校正後預測線": np.concatenate([gap, forecast]),
+                "預測上緣": np.concatenate([gap, forecast + std_dev]),
+                "預測下緣": np.concatenate([gap, forecast - std_dev]),
+            })
+            st.line_chart(chart_df, color=["#1f77b4", "#ff0000", "#ffcccc", "#ffcccc"])
             
             # 顯示具體數字
             st.write("### 校正後未來 7 天目標價")
-            dates = [(datetime.now() + timedelta(days=i+1)).strftime("%Y-%m-%d") for i in range(7)]
-            st.table(pd.DataFrame({"日期": dates, "預測目標": [f"{v:.2f}" for v in forecast]}))
+            # 預測步長是交易日，從最後一根K棒的隔天起算 7 個營業日
+            dates = pd.bdate_range(last_ts + np.timedelta64(1, "D"), periods=len(forecast)).strftime("%Y-%m-%d")
+            # 數值原樣送出，小數位數交給前端格式化
+            st.dataframe(
+                pd.DataFrame({"日期": dates, "預測目標": forecast}),
+                column_config={"預測目標": st.column_config.NumberColumn(format="%.2f")},
+                hide_index=True,
+            )
 
     # --- TAB 3: 模型日誌 ---
     with tab3:
         st.subheader("🤖 模型自我學習紀錄")
-        st.write(f"模型最後學習日期: {df.index[-1].strftime('%Y-%m-%d')}")
-        st.write(f"餵入訓練數據量: {len(df)} 筆")
+        st.write(f"模型最後學習日期: {last_ts}")
+        st.write(f"餵入訓練數據量: {close.size} 筆")
         
         # 誤差檢驗邏輯
-        yesterday_pred = df['Close'].iloc[-2] # 簡化邏輯：拿前一天看今天
-        today_actual = df['Close'].iloc[-1]
-        error = abs(today_actual - yesterday_pred) / today_actual * 100
+        # 簡化邏輯：拿前一天看今天
+        error = fabs(last_close - prev_close) / last_close * 100.0
         
         st.metric("昨日預測偏差值", f"{error:.2f}%")
         
@@ -122,5 +255,14 @@ else:
             st.success("✨ 預測與實際走勢契合，模型參數保持最優狀態。")
 
         if st.button("手動強制重啟模型學習"):
-            st.cache_data.clear()
+            # 只讓這檔股票的磁碟與記憶體快取失效，其他代碼的快取保留
+            # 磁碟檔案不刪除，只把修改時間設為過期：下載失敗時仍可沿用舊歷史
+            # 預測結果的快取鍵含最後日期與收盤價，資料一變就自然失效
+            path = _cache_path(stock_id)
+            if path is not None:  # 不合法的代碼不碰任何檔案
+                try:
+                    os.utime(path, (0, 0))
+                except FileNotFoundError:
+                    pass
+            load_data.clear(stock_id)
             st.rerun()